@@ -4,22 +4,87 @@ VIES API Checker - Advanced monitoring for EU VIES API
 Measures availability, response time and VAT number validation
 """
 
+import bisect
 import json
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import DEFAULT_ACCEPT_ENCODING
+from urllib3.util.retry import Retry
 from datetime import datetime
 import os
 import subprocess
 import sys
-from typing import Dict, List, Any
+import threading
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Any
+
+try:
+    import orjson  # Optional C-backed JSON, several times faster than stdlib json
+except ImportError:
+    orjson = None
+
+
+def _loads(data: bytes) -> Any:
+    """Parse JSON bytes with orjson when available, stdlib json otherwise"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _dumps(obj: Any, indent: bool = False) -> bytes:
+    """Serialize to UTF-8 JSON bytes - compact by default, 2-space indent for human-facing files"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class UrlSpec(NamedTuple):
+    """Normalized URL config - defaults resolved once instead of on every check"""
+    name: str
+    url: str
+    timeout: float
+    expected_status: int
+    expected_content: bytes
+
 
 class VIESChecker:
     def __init__(self, config_file: str = "config.json"):
         """Initialize VIES checker"""
         self.config = self.load_config(config_file)
+        self.url_specs = [
+            UrlSpec(
+                name=c['name'],
+                url=c['url'],
+                timeout=c.get('timeout', 15),
+                expected_status=c.get('expected_status', 200),
+                expected_content=(c.get('expected_content', 'isValid') or '').encode('utf-8')
+            )
+            for c in self.config['urls']
+        ]
+        # Entries that differ only by name share one request per tick
+        self.unique_specs = {}
+        for spec in self.url_specs:
+            self.unique_specs.setdefault(spec[1:], spec)
         self.results_file = "results.json"
-        self.measurements = self.load_measurements()  # All measurements
+        self.measurements_file = "measurements.jsonl"
+        # Statistics cover full history, in memory we only keep a bounded window
+        max_history = self.config.get('max_history', 100000)
+        if not isinstance(max_history, int) or max_history < 1:
+            print(f"Error: max_history must be a positive integer, got {max_history!r}")
+            sys.exit(1)
+        self.measurements = deque(maxlen=max_history)
         self.results = []  # Will be populated with current measurements
+        self.print_lock = threading.Lock()  # Keeps output readable during parallel checks
+        self.results_tracked = False  # Set after first publish - results file is then known to git
+        
+        # Stream stored measurements into the window and running statistics in one pass
+        self.rebuild_stats(self.load_measurements())
         
         # Load existing results to continue from where we left off
         self.load_existing_results()
@@ -29,14 +94,33 @@ class VIESChecker:
         self.session.headers.update({
             'User-Agent': 'VIES-Checker/1.0',
             'Accept': 'application/json',
-            'Accept-Encoding': 'gzip, deflate'
+            # gzip, deflate - plus br when a brotli decoder is installed
+            'Accept-Encoding': DEFAULT_ACCEPT_ENCODING
         })
+        
+        # Keep-alive pool sized for all monitored URLs, retry failed connection attempts.
+        # Read timeouts and 5xx responses are not retried - they are what we measure.
+        retry = Retry(
+            total=3,
+            read=False,
+            backoff_factor=0.3,
+            allowed_methods=frozenset(['GET'])
+        )
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=max(10, len(self.config['urls']) * 2),
+            max_retries=retry
+        )
+        self.session.mount('https://', adapter)
+        
+        # One long-lived pool drives all checks so worker threads are reused across ticks
+        self.executor = ThreadPoolExecutor(max_workers=max(1, min(16, len(self.unique_specs))))
     
     def load_config(self, config_file: str) -> Dict[str, Any]:
         """Load configuration from JSON file"""
         try:
-            with open(config_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(config_file, 'rb') as f:
+                return _loads(f.read())
         except FileNotFoundError:
             print(f"Error: Configuration file {config_file} not found!")
             sys.exit(1)
@@ -44,34 +128,61 @@ class VIESChecker:
             print(f"Error: Invalid JSON in {config_file}")
             sys.exit(1)
     
-    def load_measurements(self) -> List[Dict[str, Any]]:
-        """Load existing measurements from measurements.json"""
-        measurements_file = "measurements.json"
-        if os.path.exists(measurements_file):
-            try:
-                with open(measurements_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, FileNotFoundError):
-                return []
-        return []
+    def load_measurements(self) -> Iterator[Dict[str, Any]]:
+        """Stream existing measurements from measurements.jsonl (one JSON object per line)"""
+        if not os.path.exists(self.measurements_file):
+            yield from self.migrate_legacy_measurements()
+            return
+        
+        try:
+            with open(self.measurements_file, 'rb') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        yield _loads(line)
+                    except ValueError:
+                        # Skip a torn line left by an interrupted append - covers JSONDecodeError
+                        # and UnicodeDecodeError when the cut falls inside a multibyte character
+                        continue
+        except FileNotFoundError:
+            return
+    
+    def migrate_legacy_measurements(self) -> List[Dict[str, Any]]:
+        """Convert legacy measurements.json (single JSON array) to measurements.jsonl"""
+        legacy_file = "measurements.json"
+        if not os.path.exists(legacy_file):
+            return []
+        try:
+            with open(legacy_file, 'rb') as f:
+                measurements = _loads(f.read())
+        except (json.JSONDecodeError, FileNotFoundError):
+            return []
+        
+        self.save_measurements(measurements)
+        print(f"📦 Migrated {len(measurements)} measurements from {legacy_file} to {self.measurements_file}")
+        return measurements
     
     def load_existing_results(self) -> None:
         """Load existing results from results.json to continue from where we left off"""
+        if self.measurements:
+            return  # Full history already loaded from measurements.jsonl
+        
+        # Fallback - no stored measurements, seed from the last 10 values in results.json
         if os.path.exists(self.results_file):
             try:
-                with open(self.results_file, 'r', encoding='utf-8') as f:
-                    existing_results = json.load(f)
+                with open(self.results_file, 'rb') as f:
+                    existing_results = _loads(f.read())
                 
                 # If we have existing results, we need to reconstruct measurements
                 # from the last_10_values to continue the sequence
                 if existing_results.get('last_10_values'):
-                    # Clear current measurements and load from results
-                    self.measurements = []
-                    
                     # Reconstruct measurements from last_10_values
+                    reconstructed = []
                     for value in existing_results['last_10_values']:
                         measurement = {
-                            "timestamp": value['timestamp'] + ".000000",  # Add microseconds back
+                            # Normalize to full microsecond precision like live measurements
+                            "timestamp": datetime.fromisoformat(value['timestamp']).isoformat(timespec='microseconds'),
                             "name": "VIES API",
                             "url": "https://ec.europa.eu/taxation_customs/vies/rest-api/ms/CZ/vat/CZ26185610",
                             "status_code": 200 if value['success'] else None,
@@ -79,34 +190,41 @@ class VIESChecker:
                             "success": value['success'],
                             "error": None if value['success'] else "Previous error"
                         }
-                        self.measurements.append(measurement)
+                        reconstructed.append(measurement)
+                    
+                    self.rebuild_stats(reconstructed)
+                    # Persist them, so later runs load them from measurements.jsonl
+                    self.save_measurements(reconstructed)
                     
                     print(f"📊 Loaded {len(self.measurements)} measurements from existing results")
                     
-            except (json.JSONDecodeError, FileNotFoundError, KeyError) as e:
+            except (json.JSONDecodeError, FileNotFoundError, KeyError, ValueError) as e:
                 print(f"⚠️  Could not load existing results: {e}")
                 # Continue with empty measurements
     
-    def check_vies_api(self, url_config: Dict[str, Any]) -> Dict[str, Any]:
+    def check_vies_api(self, spec: UrlSpec) -> Dict[str, Any]:
         """Check VIES API focusing on response time and success/fail"""
-        name = url_config['name']
-        url = url_config['url']
-        timeout = url_config.get('timeout', 15)
-        expected_status = url_config.get('expected_status', 200)
-        expected_content = url_config.get('expected_content', 'isValid')
-        description = url_config.get('description', '')
+        name, url, timeout, expected_status, expected_content = spec
         
-        start_time = time.time()
+        start_ns = time.monotonic_ns()  # Monotonic clock - immune to NTP jumps
         timestamp = datetime.now().isoformat()
         
         try:
             # Simple measurement focused on response time
-            response = self.session.get(url, timeout=timeout)
-            response_time = round((time.time() - start_time) * 1000, 2)
+            # Context manager closes the streamed response even if reading the body fails
+            with self.session.get(url, timeout=timeout, stream=True) as response:
+                if expected_content:
+                    # Match raw bytes - skips charset detection and text decoding
+                    content_check = self.body_contains(response, expected_content)
+                else:
+                    # Status-only check - discard the body undecoded, connection goes back to the pool
+                    response.raw.drain_conn()
+                    content_check = True
+                # Timed after the whole body is read, consistent with earlier measurements
+                response_time = round((time.monotonic_ns() - start_ns) / 1e6, 2)
             
             # Basic success check
             status_check = response.status_code == expected_status
-            content_check = expected_content in response.text if expected_content else True
             success = status_check and content_check
             
             # Simple result structure
@@ -122,10 +240,11 @@ class VIESChecker:
             
             # Simple output focused on time and success
             status_icon = "✅" if success else "❌"
-            print(f"{status_icon} {name}: {response.status_code} ({response_time}ms)")
+            with self.print_lock:
+                print(f"{status_icon} {name}: {response.status_code} ({response_time}ms)")
             
         except requests.exceptions.Timeout:
-            timeout_time = round((time.time() - start_time) * 1000, 2)
+            timeout_time = round((time.monotonic_ns() - start_ns) / 1e6, 2)
             result = {
                 "timestamp": timestamp,
                 "name": name,
@@ -135,10 +254,11 @@ class VIESChecker:
                 "success": False,
                 "error": "Timeout"
             }
-            print(f"⏰ {name}: Timeout after {timeout_time}ms")
+            with self.print_lock:
+                print(f"⏰ {name}: Timeout after {timeout_time}ms")
             
         except requests.exceptions.ConnectionError:
-            connection_time = round((time.time() - start_time) * 1000, 2)
+            connection_time = round((time.monotonic_ns() - start_ns) / 1e6, 2)
             result = {
                 "timestamp": timestamp,
                 "name": name,
@@ -148,10 +268,11 @@ class VIESChecker:
                 "success": False,
                 "error": "Connection Error"
             }
-            print(f"🔌 {name}: Connection Error after {connection_time}ms")
+            with self.print_lock:
+                print(f"🔌 {name}: Connection Error after {connection_time}ms")
             
         except Exception as e:
-            error_time = round((time.time() - start_time) * 1000, 2)
+            error_time = round((time.monotonic_ns() - start_ns) / 1e6, 2)
             result = {
                 "timestamp": timestamp,
                 "name": name,
@@ -161,37 +282,63 @@ class VIESChecker:
                 "success": False,
                 "error": str(e)
             }
-            print(f"❌ {name}: {str(e)} after {error_time}ms")
+            with self.print_lock:
+                print(f"❌ {name}: {str(e)} after {error_time}ms")
         
         return result
     
     
+    def body_contains(self, response: requests.Response, needle: bytes) -> bool:
+        """Scan a streamed response body for needle - the full body is still read either way"""
+        found = False
+        tail = b''  # End of previous chunk, so matches spanning a chunk boundary are not missed
+        for chunk in response.iter_content(chunk_size=8192):
+            window = tail + chunk
+            if needle in window:
+                found = True
+                break
+            tail = window[-(len(needle) - 1):] if len(needle) > 1 else b''
+        # Read and discard the rest undecoded - closing early instead would drop
+        # the keep-alive connection and cost a new TLS handshake next tick
+        response.raw.drain_conn()
+        return found
+    
     def check_vies_api_endpoint(self) -> None:
         """Check VIES API endpoint"""
         print(f"\n🔍 VIES API Monitoring - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         print("=" * 60)
         
-        new_results = []
-        for url_config in self.config['urls']:
-            result = self.check_vies_api(url_config)
-            new_results.append(result)
+        # Checks are independent network I/O - run them concurrently over the pooled session
+        checked = dict(zip(self.unique_specs, self.executor.map(self.check_vies_api, self.unique_specs.values())))
+        # Fan each result out to every config entry with the same check, keeping its name
+        new_results = [dict(checked[spec[1:]], name=spec.name) for spec in self.url_specs]
         
         # Add new results to existing measurements
         self.measurements.extend(new_results)
+        for result in new_results:
+            self.update_stats(result)
         
         # Save measurements and generate statistics
-        self.save_measurements()
+        self.save_measurements(new_results)
         self.save_results()
         
         # Publish to GitHub (if enabled)
         if self.config.get('auto_publish', False):
             self.publish_to_github()
     
-    def save_measurements(self) -> None:
-        """Save individual measurements to measurements.json"""
+    def save_measurements(self, new_results: List[Dict[str, Any]]) -> None:
+        """Append new measurements to measurements.jsonl"""
         try:
-            with open("measurements.json", 'w', encoding='utf-8') as f:
-                json.dump(self.measurements, f, indent=2, ensure_ascii=False)
+            # Compact separators and one buffered write per tick
+            payload = b''.join(_dumps(result) + b'\n' for result in new_results)
+            with open(self.measurements_file, 'ab+', buffering=65536) as f:
+                # Terminate a torn line left by an interrupted append, so the
+                # first new record starts on its own line and is not lost with it
+                if f.seek(0, os.SEEK_END) > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        payload = b'\n' + payload
+                f.write(payload)
         except Exception as e:
             print(f"❌ Error saving measurements: {e}")
     
@@ -206,8 +353,10 @@ class VIESChecker:
             stats["last_updated"] = datetime.now().isoformat()
             stats["checker_version"] = "1.0"
             
-            with open(self.results_file, 'w', encoding='utf-8') as f:
-                json.dump(stats, f, indent=2, ensure_ascii=False)
+            # Human-facing file keeps indent=2, but is serialized up front and written once
+            payload = _dumps(stats, indent=True)
+            with open(self.results_file, 'wb', buffering=65536) as f:
+                f.write(payload)
             print(f"\n💾 VIES statistics saved to {self.results_file}")
         except Exception as e:
             print(f"❌ Error saving results: {e}")
@@ -221,9 +370,13 @@ class VIESChecker:
                 print("⚠️  Not a git repository, skipping publication")
                 return
             
-            subprocess.run(['git', 'add', self.results_file], check=True)
+            # Committing the path directly stages it too, so `git add` is only
+            # needed the first time in case the results file is not tracked yet
+            if not self.results_tracked:
+                subprocess.run(['git', 'add', self.results_file], check=True)
             commit_message = f"VIES API results update - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-            subprocess.run(['git', 'commit', '-m', commit_message], check=True)
+            subprocess.run(['git', 'commit', '-m', commit_message, '--', self.results_file], check=True)
+            self.results_tracked = True
             subprocess.run(['git', 'push'], check=True)
             
             print("✅ VIES results successfully uploaded to GitHub!")
@@ -233,29 +386,59 @@ class VIESChecker:
         except Exception as e:
             print(f"❌ Unexpected error during publication: {e}")
     
+    def rebuild_stats(self, measurements: Iterable[Dict[str, Any]]) -> None:
+        """Compute running statistics in a single pass, appending measurements to the window"""
+        self._total = 0
+        self._successful = 0
+        self._rt_sum = 0.0
+        response_times = array('d')
+        for r in measurements:
+            self.measurements.append(r)
+            self._total += 1
+            if r['success']:
+                self._successful += 1
+            if r['response_time_ms']:
+                self._rt_sum += r['response_time_ms']
+                response_times.append(r['response_time_ms'])
+        # Contiguous doubles kept sorted so min, max and median are direct lookups.
+        # Sorting needs a transient list of floats - drop it as soon as it is copied.
+        sorted_times = sorted(response_times)
+        del response_times
+        self._sorted_rt = array('d', sorted_times)
+        del sorted_times
+    
+    def update_stats(self, result: Dict[str, Any]) -> None:
+        """Fold a single new measurement into the running statistics"""
+        self._total += 1
+        if result['success']:
+            self._successful += 1
+        response_time = result['response_time_ms']
+        if response_time:
+            self._rt_sum += response_time
+            bisect.insort(self._sorted_rt, response_time)
+    
     def get_vies_stats(self) -> Dict[str, Any]:
         """Return VIES API statistics focused on response time and success/fail"""
-        if not self.measurements:
+        if self._total == 0:
             return {"total_checks": 0}
         
-        # Calculate statistics from all measurements
-        total_checks = len(self.measurements)
-        successful_checks = sum(1 for r in self.measurements if r['success'])
+        # Statistics from all measurements, maintained incrementally
+        total_checks = self._total
+        successful_checks = self._successful
         failed_checks = total_checks - successful_checks
         
         # Calculate success rate from all measurements
         success_rate = round((successful_checks / total_checks) * 100, 1) if total_checks > 0 else 0
         
-        # Calculate response time statistics from all measurements
-        response_times = [r['response_time_ms'] for r in self.measurements if r['response_time_ms']]
-        avg_response_time = sum(response_times) / len(response_times) if response_times else 0
-        min_response_time = min(response_times) if response_times else 0
-        max_response_time = max(response_times) if response_times else 0
+        # Response time statistics from all measurements
+        sorted_times = self._sorted_rt
+        avg_response_time = self._rt_sum / len(sorted_times) if sorted_times else 0
+        min_response_time = sorted_times[0] if sorted_times else 0
+        max_response_time = sorted_times[-1] if sorted_times else 0
         
-        # Calculate median from all measurements
+        # Median straight from the sorted response times
         median_response_time = 0
-        if response_times:
-            sorted_times = sorted(response_times)
+        if sorted_times:
             n = len(sorted_times)
             if n % 2 == 0:
                 median_response_time = (sorted_times[n//2 - 1] + sorted_times[n//2]) / 2
@@ -263,7 +446,7 @@ class VIESChecker:
                 median_response_time = sorted_times[n//2]
         
         # Last 10 measurements statistics (for recent trends)
-        last_10_results = self.measurements[-10:] if len(self.measurements) >= 10 else self.measurements
+        last_10_results = list(islice(reversed(self.measurements), 10))[::-1]
         last_10_response_times = [r['response_time_ms'] for r in last_10_results if r['response_time_ms']]
         last_10_avg = sum(last_10_response_times) / len(last_10_response_times) if last_10_response_times else 0
         last_10_successful = sum(1 for r in last_10_results if r['success'])